@@ -61,7 +61,9 @@ class ProgressBytesIO(io.BytesIO):
                              progress_cb(num_chars_read, total_buffer_size)
         '''
         super().__init__(data)
-        self._progress_cb = progress_cb
+        # Resolve the callback once - read() runs per chunk and should not
+        # re-check callability every time.
+        self._progress_cb = progress_cb if callable(progress_cb) else None
         self._total_size = len(data)
         self._progress = 0
 
@@ -74,12 +76,8 @@ class ProgressBytesIO(io.BytesIO):
         chars_read = super().read(size)
         self._progress += len(chars_read)
 
-        if self._progress_cb is not None and callable(self._progress_cb):
-            try:
-                self._progress_cb(self._progress, self._total_size)
-            except Exception as e:
-                print(e)
-                raise
+        if self._progress_cb is not None:
+            self._progress_cb(self._progress, self._total_size)
 
         return chars_read
 
@@ -142,3 +142,8 @@ class StreamMap(metaclass=Singleton):
             return self._stream_infos.get(chan_name, None) or self._get_dynamic_info(chan_name)
         except ValueError:
             raise StreamConfigError("Channel '{0}' doesn't exist.".format(chan_name))
+
+
+# The one StreamMap every caller shares. Using this module attribute skips
+# the Singleton metaclass __call__ check that StreamMap() pays per lookup.
+stream_map = StreamMap()
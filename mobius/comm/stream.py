@@ -2,6 +2,7 @@ import logging
 import os
 
 import zmq
+import zmq.asyncio
 from zmq.eventloop.zmqstream import ZMQStream
 
 from mobius.comm import comm_config
@@ -19,6 +20,9 @@ SEPARATOR = b''
 REPLY_CODE = b'REP'
 RECV_CODE = b'RCV'
 
+# How many additional pending messages a stream drains per loop wakeup.
+RECV_DRAIN_LIMIT = 100
+
 
 def unroll_list(item_list):
     '''
@@ -112,6 +116,7 @@ class Stream:
         self._reply_type = stream_info.reply_type
         self._on_recv = on_recv
         self._on_send = on_send
+        self._draining = False
 
         self._stream = ZMQStream(socket, io_loop=loop)
 
@@ -203,7 +208,7 @@ class Stream:
 
         data = msg.SerializeToString()
         msgs = [SEPARATOR, RECV_CODE, data]
-        self._stream.send_multipart(msgs, **kwds)
+        self._send_multipart(msgs, **kwds)
 
     def reply(self, ids, msg, **kwds):
         '''
@@ -224,6 +229,39 @@ class Stream:
         data = msg.SerializeToString()
 
         msgs = list(unroll_list([ids, SEPARATOR, REPLY_CODE, data]))
+        self._send_multipart(msgs, **kwds)
+
+    def reply_serialized(self, ids, data, **kwds):
+        '''
+        Reply with an already serialized message. Skips the type check and
+        serialization that reply() performs - for callers that assemble the
+        wire bytes themselves, for instance by concatenating a precomputed
+        prefix with the varying fields.
+
+        @param ids - a list of socket ids to reply to
+        @param data - serialized message bytes
+        @param kwds - extra keywords that zmq's stream send accepts.
+        '''
+        msgs = list(unroll_list([ids, SEPARATOR, REPLY_CODE, data]))
+        self._send_multipart(msgs, **kwds)
+
+    def _send_multipart(self, msgs, **kwds):
+        '''
+        Send frames, trying the socket synchronously first. For the small
+        messages the services exchange, the POLLOUT round-trip through the
+        stream's send queue dominates the cost - when nothing is queued and
+        no send callback needs to fire, write straight to the socket and
+        only fall back to the queued path when zmq pushes back.
+
+        @param msgs - list of frames to send
+        @param kwds - extra keywords that zmq's stream send accepts.
+        '''
+        if self._on_send is None and not kwds and not self._stream.sending():
+            try:
+                self._stream.socket.send_multipart(msgs, flags=zmq.NOBLOCK)
+                return
+            except zmq.Again:
+                pass
         self._stream.send_multipart(msgs, **kwds)
 
     def _get_msg_type(self, op_code):
@@ -270,6 +308,16 @@ class Stream:
 
     def _recv_wrapper(self, data):
         self._callback_wrapper(data, self._on_recv)
+        # Under a burst there are usually more messages already sitting in the
+        # zmq queue. Draining them here amortizes one event loop wakeup across
+        # the whole burst instead of paying a callback hop per message. flush
+        # re-enters this wrapper for every drained message, hence the guard.
+        if not self._draining:
+            self._draining = True
+            try:
+                self._stream.flush(zmq.POLLIN, limit=RECV_DRAIN_LIMIT)
+            finally:
+                self._draining = False
 
     def _send_wrapper(self, data, _):
         self._callback_wrapper(data, self._on_send)
@@ -287,17 +335,19 @@ class Socket:
     IOLoop. It is IPC only, and is intended to facilitate communications from
     the service worker processes to the parent service.
     '''
-    def __init__(self, chan_name, sock_type, bind=True):
+    def __init__(self, chan_name, sock_type, bind=True, sndhwm=None):
         '''
         Initialize this socket.
 
         @param chan_name - name of the channel this channel will communicate on
         @param sock_type - what type of socket is this suppose to be. (zmq.PUB etc)
         @param bind - does this socket bind, or connect
+        @param sndhwm - optional send high water mark, bounding how many
+                        outgoing messages zmq queues before pushing back
         '''
         chan_name = chan_name.rstrip("/")
         # TODO: Move ZmqAddress to stream info
-        self._stream_info = comm_config.StreamMap().get_stream_info(chan_name)
+        self._stream_info = comm_config.stream_map.get_stream_info(chan_name)
         zmq_address = ZmqAddress(chan_name=chan_name)
 
         ctx = zmq.Context.instance()
@@ -306,6 +356,9 @@ class Socket:
         if sock_type == zmq.SUB:
             self._sock.setsockopt(zmq.SUBSCRIBE, b'')
 
+        if sndhwm is not None:
+            self._sock.setsockopt(zmq.SNDHWM, sndhwm)
+
         if bind:
             self._sock.bind(zmq_address.zmq_url())
         else:
@@ -347,6 +400,30 @@ class Socket:
         msgs = list(unroll_list([envelope, SEPARATOR, REPLY_CODE, data]))
         self._sock.send_multipart(msgs, **kwds)
 
+    def reply_prefix(self, envelope):
+        '''
+        Precompute the routing frames for replies to a fixed envelope. Callers
+        that reply to the same requestor many times can build this list once
+        and pass it to reply_serialized for every message.
+
+        @param envelope - a list of socket ids to reply to
+        @returns list of frames preceding the payload of a reply
+        '''
+        return list(unroll_list([envelope, SEPARATOR, REPLY_CODE]))
+
+    def reply_serialized(self, prefix, data, **kwds):
+        '''
+        Reply with an already serialized message, prefixed with routing frames
+        built by reply_prefix. The frames are handed to zmq without an
+        intermediate buffer copy, which skips the per-call envelope unrolling
+        and type checking of reply().
+
+        @param prefix - routing frames as returned by reply_prefix
+        @param data - serialized message bytes
+        @param kwds - extra keywords that zmq's socket send accepts.
+        '''
+        self._sock.send_multipart(prefix + [data], copy=False, **kwds)
+
     def _get_msg_type(self, op_code):
         '''
         Given the op code determine what message type is expected.
@@ -426,8 +503,7 @@ class RouterPubSubProxy:
         self._back_in_stream.bind(back_in_address.zmq_url())
 
         def callback(from_name, to_name, zmq_stream, msgs):
-            log.info("Routing from {0} to {1} messages {2}"
-                     .format(from_name, to_name, msgs))
+            log.info("Routing from %s to %s messages %s", from_name, to_name, msgs)
             zmq_stream.send_multipart(msgs)
             zmq_stream.flush()
 
@@ -475,8 +551,7 @@ class LocalRequestProxy:
         self._back_end.connect(back_address.zmq_url())
 
         def callback(from_name, to_name, zmq_stream, msgs):
-            log.debug("Routing from {0} to {1} messages {2}"
-                      .format(from_name, to_name, msgs))
+            log.debug("Routing from %s to %s messages %s", from_name, to_name, msgs)
             zmq_stream.send_multipart(msgs)
             zmq_stream.flush()
 
@@ -505,7 +580,7 @@ class SocketFactory:
         Helper method to create streams.
         '''
         chan_name = chan_name.rstrip("/")
-        stream_info = comm_config.StreamMap().get_stream_info(chan_name)
+        stream_info = comm_config.stream_map.get_stream_info(chan_name)
         zmq_address = ZmqAddress(transport=transport, host=host, chan_name=chan_name, port=port)
 
         if bind:
@@ -680,3 +755,70 @@ class SocketFactory:
         socket = context.socket(zmq.PAIR)
 
         return SocketFactory._make_stream(socket, chan_name, on_recv, on_send, host, transport, port, bind, loop)
+
+    @staticmethod
+    def _make_async_socket(sock_type, chan_name, host=None, transport=IPC, port=None, bind=True):
+        '''
+        Helper method to create asyncio sockets. Unlike the stream factories
+        above, these sockets integrate with the running asyncio loop through
+        zmq.asyncio directly - no ZMQStream poller in between - and hand raw
+        multipart frames to the caller via awaitable recv_multipart().
+
+        @returns zmq.asyncio.Socket
+        '''
+        chan_name = chan_name.rstrip("/")
+        zmq_address = ZmqAddress(transport=transport, host=host, chan_name=chan_name, port=port)
+
+        context = zmq.asyncio.Context.instance()
+        socket = context.socket(sock_type)
+
+        if sock_type == zmq.SUB:
+            socket.setsockopt(zmq.SUBSCRIBE, b'')
+
+        if bind:
+            socket.bind(zmq_address.zmq_url())
+        else:
+            socket.connect(zmq_address.zmq_url())
+        return socket
+
+    @staticmethod
+    def async_sub_socket(chan_name, host=None, transport=IPC, port=None, bind=False):
+        '''
+        Create an asyncio subscriber socket on the specified chan_name.
+
+        @param chan_name - chan_name of this socket
+        @param host - hostname, or ip address on which this socket will communicate
+        @param transport - what kind of transport to use for messaging(inproc, ipc, tcp etc)
+        @param port - port number to connect to
+        @param bind - should this socket bind, or connect
+        @returns zmq.asyncio.Socket
+        '''
+        return SocketFactory._make_async_socket(zmq.SUB, chan_name, host, transport, port, bind)
+
+    @staticmethod
+    def async_pub_socket(chan_name, host=None, transport=IPC, port=None, bind=True):
+        '''
+        Create an asyncio publish socket on the specified chan_name.
+
+        @param chan_name - chan_name of this socket
+        @param host - hostname, or ip address on which this socket will communicate
+        @param transport - what kind of transport to use for messaging(inproc, ipc, tcp etc)
+        @param port - port number to connect to
+        @param bind - should this socket bind, or connect
+        @returns zmq.asyncio.Socket
+        '''
+        return SocketFactory._make_async_socket(zmq.PUB, chan_name, host, transport, port, bind)
+
+    @staticmethod
+    def async_dealer_socket(chan_name, host=None, transport=IPC, port=None, bind=True):
+        '''
+        Create an asyncio dealer socket on the specified chan_name.
+
+        @param chan_name - chan_name of this socket
+        @param host - hostname, or ip address on which this socket will communicate
+        @param transport - what kind of transport to use for messaging(inproc, ipc, tcp etc)
+        @param port - port number to connect to
+        @param bind - should this socket bind, or connect
+        @returns zmq.asyncio.Socket
+        '''
+        return SocketFactory._make_async_socket(zmq.DEALER, chan_name, host, transport, port, bind)
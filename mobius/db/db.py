@@ -66,7 +66,9 @@ class Transaction(Base):
 
 class ProviderInfo(Base):
     __tablename__ = "provider_infos"
-    __table_args__ = (UniqueConstraint("mobius_id", "remote_id", name="unique_id"),)
+    __table_args__ = (UniqueConstraint("mobius_id", "remote_id", name="unique_id"),
+                      UniqueConstraint("mobius_id", "provider_id",
+                                       name="unique_mobius_provider"),)
 
     id = Column(Integer, Sequence("provider_info_seq"), primary_key=True)
     provider_id = Column(Integer)
@@ -87,7 +89,7 @@ class DBHandle:
     '''
     Helper class to get access to the database.
     '''
-    def __init__(self, url, verbose=False):
+    def __init__(self, url, verbose=False, pool_size=10, max_overflow=0, pool_pre_ping=False):
         '''
         Initialize a handle to the database
 
@@ -95,8 +97,17 @@ class DBHandle:
                      etc), user, password and database name.
         @param verbose - should the underlying SQL queries be echoed to log
                          output
+        @param pool_size - number of connections kept open in the pool
+        @param max_overflow - number of connections allowed above pool_size
+        @param pool_pre_ping - should connections be tested before checkout
         '''
-        self._engine = create_engine(url, echo=verbose)
+        self._engine = create_engine(url,
+                                     echo=verbose,
+                                     pool_size=pool_size,
+                                     max_overflow=max_overflow,
+                                     pool_pre_ping=pool_pre_ping,
+                                     query_cache_size=1200,
+                                     execution_options={"compiled_cache": {}})
         Base.metadata.create_all(self._engine)
         self._session = scoped_session(sessionmaker(bind=self._engine))
 
@@ -8,12 +8,12 @@ from mobius.comm.stream import SocketFactory
 from mobius.db import db
 from mobius.service import AbstractCommand, AbstractFactory, BaseService, Command
 from mobius.utils import set_up_logging, JSONObject
-from mobius.utils import eventloop
+from mobius.utils import eventloop, install_uvloop
 
 log = logging.getLogger(__name__)
 
 
-NUM_WORKERS = 2
+NUM_WORKERS = int(os.environ.get("MOBIUS_NUM_WORKERS", 2))
 username = "vagrant"
 authentication = "tmp"
 dbname = "mydb"
@@ -62,11 +62,11 @@ class SaveFile(AbstractCommand):
 
             session.add(file_3d)
             session.commit()
-            log.debug("File saved, removing it: {0}".format(self._path))
+            log.debug("File saved, removing it: %s", self._path)
             try:
                 os.remove(self._path)
             except OSError:
-                log.error("Unable to delete file: {0}".format(self._path))
+                log.error("Unable to delete file: %s", self._path)
             result = JSONObject()
             result.model_id = file_3d.id
             return result.json_string
@@ -98,7 +98,7 @@ class FindUser(AbstractCommand):
             result.id = user.id
             result.email = user.email
             result.password = user.password
-            result.date_created = str(user.date_created).split(" ", 1)[0]
+            result.date_created = user.date_created.date().isoformat()
             return result.json_string
 
 
@@ -130,7 +130,38 @@ class CreateUser(AbstractCommand):
             json_user = JSONObject()
             json_user.id = user.id
             json_user.email = user.email
-            json_user.date_created = str(user.date_created).split(" ", 1)[0]
+            json_user.date_created = user.date_created.date().isoformat()
+            return json_user.json_string
+
+
+class UpdateUser(AbstractCommand):
+    '''
+    Updates the password of an existing user.
+    '''
+    def __init__(self, user_email, user_pass, db_handle):
+        self._user_email = user_email
+        self._user_pass = user_pass
+        self._db_handle = db_handle
+
+    def initialize(self):
+        '''
+        Nothing to do here.
+        '''
+
+    def run(self):
+        '''
+        Store the new password on the user record.
+        '''
+        with self._db_handle.session_scope() as session:
+            user = session.query(db.User)\
+                                 .filter_by(email=self._user_email)\
+                                 .one()
+            user.password = self._user_pass
+            session.commit()
+
+            json_user = JSONObject()
+            json_user.id = user.id
+            json_user.email = user.email
             return json_user.json_string
 
 
@@ -145,7 +176,8 @@ class DBCommandFactory(AbstractFactory):
         self._commands = {
             Command.SAVE_FILE: self.make_save_command,
             Command.FIND_USER: self.make_find_user_command,
-            Command.CREATE_USER: self.make_create_user_command
+            Command.CREATE_USER: self.make_create_user_command,
+            Command.UPDATE_USER: self.make_update_user_command
         }
 
     @property
@@ -176,6 +208,14 @@ class DBCommandFactory(AbstractFactory):
         params = JSONObject(request.params)
         return CreateUser(params.email, params.password, db_handle)
 
+    def make_update_user_command(self, envelope, request, context):
+        '''
+        Update an existing user's password.
+        '''
+        db_handle = context['db_handle']
+        params = JSONObject(request.params)
+        return UpdateUser(params.email, params.password, db_handle)
+
 
 class DBService(BaseService):
     '''
@@ -194,7 +234,7 @@ class DBService(BaseService):
         @param executor - thread, or process pool to send work to
         @param loop - zmq event loop
         '''
-        self._db_handle = db.DBHandle(url)
+        self._db_handle = db.DBHandle(url, pool_size=NUM_WORKERS * 2)
         self._db_request = SocketFactory.router_socket("/db/request",
                                                        on_recv=self.process_request,
                                                        loop=loop)
@@ -229,6 +269,7 @@ class DBService(BaseService):
 
 def main():
     set_up_logging()
+    install_uvloop()
 
     loop = zmq.eventloop.IOLoop.instance()
 
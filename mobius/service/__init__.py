@@ -4,6 +4,7 @@ from .service import (
                       BaseService,
                       Command,
                       MobiusCommand,
+                      ParamError,
                       Parameter,
                       ProviderFactory,
                       ServiceError,
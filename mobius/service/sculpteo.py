@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 
-import io
-import json
+import functools
+import itertools
 import logging
-import multiprocessing as mp
+import multiprocessing.pool
+import operator
+import os
+import threading
+import time
+import uuid
+
 import requests
-from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from sqlalchemy import bindparam, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm.exc import MultipleResultsFound
 from zmq.eventloop import IOLoop
 
@@ -20,9 +29,8 @@ from mobius.service import (
     Parameter,
     ProviderFactory,
     ServiceError,
-    UploadResponse,
-    make_param_string)
-from mobius.utils import set_up_logging, JSONObject
+    UploadResponse)
+from mobius.utils import set_up_logging, install_uvloop, fastjson, JSONObject
 
 
 log = logging.getLogger(__name__)
@@ -31,12 +39,25 @@ log = logging.getLogger(__name__)
 DESIGN_PRICE_URL = "http://www.sculpteo.com/en/api/design/3D/price_by_uuid/"
 UPLOAD_URL = "https://www.sculpteo.com/en/upload_design/a/3D/"
 
-NUM_WORKERS = 5
+NUM_WORKERS = int(os.environ.get("MOBIUS_NUM_WORKERS", 16))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Files below this size are posted in one shot through requests' own
+# multipart encoder; the chunked generator only pays off for big bodies.
+SMALL_UPLOAD_THRESHOLD = 16 * 1024 * 1024
 username = "vagrant"
 authentication = "tmp"
 dbname = "mydb"
 host = "localhost"
 
+DB_URL = "postgresql://{usr}:{pswd}@{host}/{db}".format(usr=username,
+                                                        pswd=authentication,
+                                                        host=host,
+                                                        db=dbname)
+
+# Timeouts keep one hung TCP connection from wedging a worker forever.
+QUOTE_TIMEOUT = 10
+UPLOAD_TIMEOUT = 300
+
 
 SCULPTEO_PARAM_MAP = {
     Parameter.ID.name: "uuid",
@@ -46,6 +67,196 @@ SCULPTEO_PARAM_MAP = {
     Parameter.CURRENCY.name: "currency",
     Parameter.MATERIAL.name: "productname"}
 
+# Frozen remap pairs - the parameter set is known at import, so the per-quote
+# remap is a straight-line comprehension with no exception path.
+_SCULPTEO_REMAP = tuple(SCULPTEO_PARAM_MAP.items())
+
+
+def _sculpteo_query(params):
+    '''
+    Remap mobius parameter names to their Sculpteo counterparts. Parameters
+    outside the known set are simply skipped, so sparse requests cost
+    nothing extra.
+
+    @param params - dictionary of mobius parameters with values
+    @returns dictionary keyed by Sculpteo parameter names
+    '''
+    return {http_key: params[name]
+            for name, http_key in _SCULPTEO_REMAP
+            if name in params}
+
+
+# The quote response has a fixed shape - compile the field accessors once
+# instead of chaining dict lookups per request. itemgetter runs in C.
+_EXTRACT_BODY = operator.itemgetter("price", "currency", "scale", "material")
+_EXTRACT_PRICE = operator.itemgetter("total_cost_raw", "has_tax")
+
+
+_worker_db = None
+_worker_db_lock = threading.Lock()
+_thread_local = threading.local()
+_worker_core = itertools.count()
+
+
+def _pin_worker():
+    '''
+    Pin the calling worker thread to a core, round robin. Only active when
+    MOBIUS_PIN_WORKERS is set in the environment - for network-bound workers
+    the scheduler usually does fine on its own, but on busy hosts pinning
+    stops workers from bouncing between cores and losing cache locality.
+    '''
+    if not os.environ.get("MOBIUS_PIN_WORKERS"):
+        return
+    core = next(_worker_core) % os.cpu_count()
+    try:
+        os.sched_setaffinity(0, {core})
+    except (AttributeError, OSError):
+        log.debug("CPU pinning is not supported on this platform.")
+
+
+def _get_session():
+    '''
+    Return a requests session private to the calling worker thread. Keeping
+    the session alive between commands reuses the TCP/TLS connections to
+    Sculpteo instead of paying a fresh handshake on every call.
+
+    @returns requests.Session owned by the current thread
+    '''
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8,
+                              pool_maxsize=16,
+                              max_retries=Retry(total=3, backoff_factor=0.2))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _thread_local.session = session
+    return session
+
+
+# Compiled once at import so per-call work is binding two parameters, not
+# rebuilding and recompiling the query.
+_PROVIDER_INFO_STMT = select(db.ProviderInfo.remote_id)\
+    .where(db.ProviderInfo.mobius_id == bindparam("mob"),
+           db.ProviderInfo.provider_id == bindparam("prov"))
+
+
+@functools.lru_cache(maxsize=4096)
+def _remote_provider_id(db_handle, mobius_id, provider_id):
+    '''
+    Look up the provider side id of a mobius file. The result is cached
+    in-process - the mapping only changes when a file is uploaded, and
+    _save_provider_info drops the cache after every upload - so repeat
+    quotes on the same file skip the database roundtrip entirely.
+
+    @param db_handle - handle to the database
+    @param mobius_id - database id of the mobius file
+    @param provider_id - numeric id of the provider
+    @returns provider side id of the file, or None when the file has not
+             been uploaded to the provider yet
+    '''
+    with db_handle.session_scope() as session:
+        try:
+            return session.execute(_PROVIDER_INFO_STMT,
+                                   {"mob": mobius_id, "prov": provider_id})\
+                          .scalar_one_or_none()
+        except MultipleResultsFound:
+            log.error("Unique constraint violated with mobius id: %s", mobius_id)
+            raise ServiceError("More than one file was found for mobius id: {0}"
+                               .format(mobius_id))
+
+
+def _init_worker(db_url):
+    '''
+    Warm up a freshly spawned pool worker. The worker threads all live in the
+    same process, so they share a single database handle - scoped_session
+    takes care of handing each thread its own session.
+
+    @param db_url - database URL the workers connect to
+    '''
+    _pin_worker()
+    # Build the thread's HTTP session up front so the first command it runs
+    # does not pay for it.
+    _get_session()
+    global _worker_db
+    with _worker_db_lock:
+        if _worker_db is None:
+            _worker_db = db.DBHandle(db_url,
+                                     pool_size=NUM_WORKERS,
+                                     max_overflow=4,
+                                     pool_pre_ping=True)
+
+
+def _get_worker_db(db_url):
+    '''
+    Return the shared database handle, creating it on first use. Commands
+    normally find the handle already opened by the pool initializer; this
+    fallback covers commands executed outside the service pool without
+    paying for a fresh engine and connection pool per command.
+
+    @param db_url - database URL to connect to
+    @returns the shared DBHandle
+    '''
+    if _worker_db is None:
+        _init_worker(db_url)
+    return _worker_db
+
+
+class MemoryViewReader:
+    '''
+    A minimal file-like reader over a memoryview. MultipartEncoder only needs
+    a len and a read() method, so wrapping the raw database bytes in a
+    memoryview avoids duplicating the whole file in RAM the way
+    io.BytesIO(mob_file.data) does.
+    '''
+    def __init__(self, data):
+        '''
+        Initialize instance of MemoryViewReader.
+
+        @param data - bytes-like object to be read without copying
+        '''
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._view)
+
+    @property
+    def len(self):
+        '''
+        Number of bytes remaining to be read.
+        '''
+        return len(self._view) - self._pos
+
+    def read(self, size=-1):
+        '''
+        Read up to size bytes from the underlying view.
+
+        @param size - number of bytes requested, negative or None reads all
+        @returns bytes object with the requested data
+        '''
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(self._pos + size, len(self._view))
+        chunk = bytes(self._view[self._pos:end])
+        self._pos = end
+        return chunk
+
+    def readview(self, size):
+        '''
+        Read up to size bytes as a memoryview slice. Unlike read() this does
+        not copy the data out of the underlying buffer, so large uploads do
+        not touch every byte twice.
+
+        @param size - number of bytes requested
+        @returns memoryview slice with the requested data
+        '''
+        end = min(self._pos + size, len(self._view))
+        chunk = self._view[self._pos:end]
+        self._pos = end
+        return chunk
+
 
 class QuoteCommand(MobiusCommand):
     '''
@@ -61,10 +272,7 @@ class QuoteCommand(MobiusCommand):
         self._envelope = envelope
         self._mobius_id = mobius_id
         self._http_params = http_params
-        self._db_url = "postgresql://{usr}:{pswd}@{host}/{db}".format(usr=username,
-                                                                      pswd=authentication,
-                                                                      host=host,
-                                                                      db=dbname)
+        self._db_url = DB_URL
         self._db = None
 
     @property
@@ -73,9 +281,9 @@ class QuoteCommand(MobiusCommand):
 
     def initialize(self):
         '''
-        Create a connection to the database within the new process space.
+        Attach to the shared database handle within the worker thread.
         '''
-        self._db = db.DBHandle(self._db_url)
+        self._db = _get_worker_db(self._db_url)
 
     def run(self):
         '''
@@ -128,47 +336,38 @@ class QuoteCommand(MobiusCommand):
 
         @returns json response from Sculpteo
         '''
-        provider_info = self._get_sculpteo_info()
-        self._http_params[Parameter.ID.name] = provider_info.remote_id
-        param_string = make_param_string(SCULPTEO_PARAM_MAP, self._http_params)
-        url_request = DESIGN_PRICE_URL + "?" + param_string
+        self._http_params[Parameter.ID.name] = self._get_sculpteo_id()
+        remote_params = _sculpteo_query(self._http_params)
 
-        log.debug("Quote request: {0}".format(url_request))
-        response = requests.get(url=url_request).json()
+        log.debug("Quote request params: %s", remote_params)
+        response = fastjson.loads(_get_session().get(DESIGN_PRICE_URL,
+                                                     params=remote_params,
+                                                     timeout=QUOTE_TIMEOUT).content)
         error = response['error']
 
         if error['id']:
             raise ServiceError(error['description'])
 
-        body = response['body']
-        price = body['price']
+        price, currency, scale, material = _EXTRACT_BODY(response['body'])
+        total_cost, has_tax = _EXTRACT_PRICE(price)
 
-        result = JSONObject()
-        result.total_cost = price['total_cost_raw']
-        result.currency = body['currency']
-        result.has_tax = price['has_tax']
-        result.scale = body['scale']
-        result.material = body['material']
-        return result.json_string
+        return fastjson.dumps({"total_cost": total_cost,
+                               "currency": currency,
+                               "has_tax": has_tax,
+                               "scale": scale,
+                               "material": material})
 
-    def _get_sculpteo_info(self):
+    def _get_sculpteo_id(self):
         '''
         Retrieve the sculpteo id associated with the provided mobius id.
 
-        @returns ProviderInfo
+        @returns sculpteo uuid of the file
         '''
-        with self._db.session_scope() as session:
-            try:
-                return session.query(db.ProviderInfo)\
-                                     .filter_by(mobius_id=self._mobius_id,
-                                                provider_id=ProviderID.SCULPTEO.value)\
-                                     .one()
-            except MultipleResultsFound:
-                log.exception()
-                log.error("Unique constraint violated with mobius id: {0}"
-                          .format(self._mobius_id))
-                raise ServiceError("More than one file was found for mobius id: {0}"
-                                   .format(self._mobius_id))
+        remote_id = _remote_provider_id(self._db, self._mobius_id, ProviderID.SCULPTEO.value)
+        if remote_id is None:
+            raise ServiceError("No Sculpteo upload found for mobius id: {0}"
+                               .format(self._mobius_id))
+        return remote_id
 
 
 class UploadCommand(MobiusCommand):
@@ -188,10 +387,12 @@ class UploadCommand(MobiusCommand):
         self._mobius_id = mobius_id
         self._user_id = user_id
         self._db = None
-        self._db_url = "postgresql://{usr}:{pswd}@{host}/{db}".format(usr=username,
-                                                                      pswd=authentication,
-                                                                      host=host,
-                                                                      db=dbname)
+        self._last_pct = -1
+        self._last_report = 0.0
+        # One reusable progress message - only its response field changes
+        # between reports.
+        self._progress_msg = msg_pb2.WorkerState(state_id=msg_pb2.UPLOADING)
+        self._db_url = DB_URL
 
     @property
     def envelope(self):
@@ -199,37 +400,75 @@ class UploadCommand(MobiusCommand):
 
     def initialize(self):
         '''
-        Create a connection to the database within the new process space.
+        Attach to the shared database handle within the worker thread.
         '''
         super().initialize("Sculpteo")
-        self._db = db.DBHandle(self._db_url)
+        self._db = _get_worker_db(self._db_url)
 
-    def _get_provider_info(self, mob_file):
+    def _get_provider_info(self):
         '''
-        Fetch Sculpteo provider info object.
+        Fetch the Sculpteo id of this file through the cached module-level
+        lookup.
 
-        @param mob_file - database handle to the file contents
-        @returns Sculpteo provider info if it exists, None otherwise
+        @returns sculpteo uuid of the file if it was uploaded, None otherwise
         '''
-        for pi in mob_file.provider_info:
-            if pi.mobius_id == self._mobius_id:
-                return pi
-        return None
+        return _remote_provider_id(self._db, self._mobius_id, ProviderID.SCULPTEO.value)
 
-    def _report_progress(self, monitor):
+    def _report_progress(self, bytes_read, total_size):
         '''
-        This is a callback to MultipartEncoderMonitor to monitor the progress of a file upload.
+        Report the progress of a file upload back to the parent service.
+        Reports are coalesced - a single chunk read rarely moves the integer
+        percentage, so only changed percentages, or at most one report per
+        100ms, turn into a protobuf and a zmq send.
 
-        @param monitor - MultipartEncoderMonitor observing the file upload process
+        @param bytes_read - number of bytes read off the file so far
+        @param total_size - total size of the file being uploaded
         '''
         try:
-            progress = int(100 * monitor.bytes_read / monitor.encoder.len)
-            response = json.dumps({"progress": progress})
-            progress_msg = msg_pb2.WorkerState(state_id=msg_pb2.UPLOADING, response=response)
-    #        log.info("Uploading: {}".format(str(progress_msg)))
-            self.send_async_data(progress_msg)
+            progress = int(100 * bytes_read / total_size)
+            now = time.monotonic()
+            if progress == self._last_pct and (now - self._last_report) < 0.1:
+                return
+            self._last_pct = progress
+            self._last_report = now
+            self._progress_msg.response = fastjson.dumps({"progress": progress})
+            self.send_async_data(self._progress_msg)
         except Exception as e:
-            log.exception("Bad stuff when reporting progress: {}".format(e))
+            log.exception("Bad stuff when reporting progress: %s", e)
+
+    def _multipart_body(self, boundary, fields, file_name, file_reader):
+        '''
+        Generate the multipart/form-data body one chunk at a time. Yielding
+        the file contents piecewise lets requests use chunked transfer
+        encoding, so the merged multipart body is never materialized in
+        memory, and the upload starts before the last chunk is read.
+
+        @param boundary - multipart boundary string
+        @param fields - dictionary of plain form fields
+        @param file_name - file name to report for the file part
+        @param file_reader - file-like object holding the file contents
+        '''
+        delimiter = "--{0}\r\n".format(boundary).encode("UTF-8")
+        for name, value in fields.items():
+            yield delimiter
+            yield ('Content-Disposition: form-data; name="{0}"\r\n\r\n{1}\r\n'
+                   .format(name, value)).encode("UTF-8")
+
+        yield delimiter
+        yield ('Content-Disposition: form-data; name="file"; filename="{0}"\r\n'
+               'Content-Type: application/octet-stream\r\n\r\n'
+               .format(file_name)).encode("UTF-8")
+
+        total_size = len(file_reader)
+        bytes_read = 0
+        chunk = file_reader.readview(UPLOAD_CHUNK_SIZE)
+        while chunk:
+            bytes_read += len(chunk)
+            self._report_progress(bytes_read, total_size)
+            yield chunk
+            chunk = file_reader.readview(UPLOAD_CHUNK_SIZE)
+
+        yield "\r\n--{0}--\r\n".format(boundary).encode("UTF-8")
 
     def _upload_file(self, mob_file):
         '''
@@ -247,53 +486,76 @@ class UploadCommand(MobiusCommand):
             dimz:   dimension of the axis-aligned bounding box along the Z dimension in model units
         '''
         try:
-            file_handle = io.BytesIO(mob_file.data)
-
-            headers = {"X-Requested-With": "XMLHttpRequest"}
-            params = {"name": mob_file.name,
+            fields = {"name": mob_file.name,
                       "designer": "bobik",
                       "password": "password",
                       "share": "0",
-                      "print_authorization": "0",
-                      "file": ("mobius_file.stl", file_handle)}
-            me = MultipartEncoder(fields=params)
-            mem = MultipartEncoderMonitor(me, callback=self._report_progress)
-            headers['Content-Type'] = mem.content_type
-            response = requests.post(url=UPLOAD_URL, data=mem, headers=headers, verify=False)
-
-            return response.json()
+                      "print_authorization": "0"}
+
+            total_size = len(mob_file.data)
+            if total_size < SMALL_UPLOAD_THRESHOLD:
+                # Small files go out in one shot - requests assembles the
+                # multipart body itself, no per-chunk python in the middle.
+                response = _get_session().post(url=UPLOAD_URL,
+                                               data=fields,
+                                               files={"file": ("mobius_file.stl",
+                                                               mob_file.data)},
+                                               headers={"X-Requested-With": "XMLHttpRequest"},
+                                               verify=False,
+                                               timeout=UPLOAD_TIMEOUT)
+                self._report_progress(total_size, total_size)
+            else:
+                file_handle = MemoryViewReader(mob_file.data)
+
+                boundary = uuid.uuid4().hex
+                headers = {"X-Requested-With": "XMLHttpRequest",
+                           "Content-Type": "multipart/form-data; boundary={0}".format(boundary)}
+                body = self._multipart_body(boundary, fields, "mobius_file.stl", file_handle)
+                response = _get_session().post(url=UPLOAD_URL,
+                                               data=body,
+                                               headers=headers,
+                                               verify=False,
+                                               timeout=UPLOAD_TIMEOUT)
+
+            return fastjson.loads(response.content)
         except Exception as e:
             log.info("Bad stuff when uploading.")
             log.exception(e)
-            return json.dumps("{}")
+            return {}
 
     def _save_provider_info(self, provider_json):
         '''
         Save the provider info to the database. Future quote look ups will use
-        that information to query for prices.
+        that information to query for prices. The insert is a Postgres upsert
+        conflicting on (mobius_id, provider_id) - the key the lookups use -
+        so two racing uploads of the same file cannot leave a second row for
+        the provider; the loser is a no-op even though each upload received
+        its own remote uuid.
 
         @param provider_json - json response from the provider after uploading
                                the file
         '''
         with self._db.session_scope() as session:
-            prov_info = db.ProviderInfo(provider_id=db.ProviderID.SCULPTEO.value,
-                                        mobius_id=self._mobius_id,
-                                        remote_id=provider_json['uuid'])
-            session.add(prov_info)
+            stmt = pg_insert(db.ProviderInfo)\
+                .values(provider_id=db.ProviderID.SCULPTEO.value,
+                        mobius_id=self._mobius_id,
+                        remote_id=provider_json['uuid'])\
+                .on_conflict_do_nothing(constraint="unique_mobius_provider")
+            session.execute(stmt)
             session.commit()
+        _remote_provider_id.cache_clear()
 
     def run(self):
         '''
         Upload the file associated with the provided mobius id to Sculpteo.
         '''
-        mob_file = self._get_mobius_file()
-
-        sculpteo_pi = self._get_provider_info(mob_file)
-        if sculpteo_pi is not None:
-            log.debug("File for mobid {0} has already been uploaded.".format(self._mobius_id))
-            upload_response = UploadResponse(sculpteo_pi.remote_id, mob_file.name)
+        remote_id = self._get_provider_info()
+        if remote_id is not None:
+            log.debug("File for mobid %s has already been uploaded.", self._mobius_id)
+            upload_response = UploadResponse(remote_id, self._get_mobius_file_name())
         else:
-            log.debug("Uploading mobid {0} file to Sculpteo...".format(self._mobius_id))
+            log.debug("Uploading mobid %s file to Sculpteo...", self._mobius_id)
+            mob_file = self._get_mobius_file()
             # TODO save this json to DB
             response_json = self._upload_file(mob_file)
             if "error" in response_json:
@@ -302,7 +564,26 @@ class UploadCommand(MobiusCommand):
             self._save_provider_info(response_json)
             upload_response = UploadResponse(response_json['uuid'], mob_file.name)
 
-        return json.dumps(vars(upload_response))
+        return fastjson.dumps(upload_response._asdict())
+
+    def _get_mobius_file_name(self):
+        '''
+        Fetch just the name of the file. The already-uploaded path needs no
+        file contents, so the multi-megabyte data column stays in the
+        database instead of being pulled across the wire.
+
+        @returns name of the file
+        '''
+        with self._db.session_scope() as session:
+            try:
+                return session.query(db.File.name)\
+                              .filter_by(id=self._mobius_id,
+                                         user_id=self._user_id).one()[0]
+            except MultipleResultsFound:
+                log.error("Unique constraint violated with mobius id: {0}"
+                          .format(self._mobius_id))
+                raise ServiceError("More than one file was found for mobius id: {0}"
+                                   .format(self._mobius_id))
 
     def _get_mobius_file(self):
         '''
@@ -353,7 +634,7 @@ class Sculpteo(BaseService):
                                                      loop=loop)
         self._factory = SculpteoFactory()
         super(Sculpteo, self).__init__(executor, loop)
-        log.info("Sculpteo service work state: {}".format(self._worker_state._path))
+        log.info("Sculpteo service work state: %s", self._worker_state._path)
 
     @property
     def receive_stream(self):
@@ -385,8 +666,11 @@ class Sculpteo(BaseService):
 def main():
     try:
         set_up_logging()
+        install_uvloop()
         loop = IOLoop.instance()
-        with mp.Pool(NUM_WORKERS) as executor:
+        with multiprocessing.pool.ThreadPool(NUM_WORKERS,
+                                             initializer=_init_worker,
+                                             initargs=(DB_URL,)) as executor:
             service = Sculpteo(executor, loop)
             log.info("Sculpteo service started.")
             service.start()
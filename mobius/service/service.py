@@ -1,20 +1,25 @@
 import abc
 import collections
 import enum
-import itertools
-import json
+import functools
 import logging
+import urllib.parse
 
 import zmq
 
 from mobius.comm.stream import SocketFactory, Socket
-from mobius.comm.msg_pb2 import Response, RESULT, ERROR, WorkerState
+from mobius.comm.msg_pb2 import Response, RESULT, ERROR
+from mobius.utils import fastjson
 
 log = logging.getLogger(__name__)
 
 
 UploadResponse = collections.namedtuple('UploadResponse', ['provider_id', 'model_name'])
 
+# Bound on queued worker-state messages - beyond this progress updates are
+# dropped instead of stalling the worker.
+WORKER_STATE_SNDHWM = 1000
+
 
 class ServiceError(Exception):
     '''
@@ -37,6 +42,7 @@ class Command(enum.IntEnum):
     SAVE_FILE = 3
     FIND_USER = 4
     CREATE_USER = 5
+    UPDATE_USER = 6
 
 
 class Parameter(enum.IntEnum):
@@ -63,17 +69,18 @@ def make_param_string(provider_map, params):
     @returns parameter string to be appended to the URL
     '''
     try:
-        params = ("=".join((provider_map[key], str(value))) for key, value in params.items())
-        param_string = "&".join(params)
-        return param_string
+        return urllib.parse.urlencode({provider_map[key]: value
+                                       for key, value in params.items()})
     except KeyError as ke:
         raise ParamError("Unable to convert parameter: {0}".format(ke.args[0]))
 
 
-class AbstractCommand(metaclass=abc.ABCMeta):
+class AbstractCommand:
     """
     This is the interface that all commands must implement to work with mobius
-    worker services.
+    worker services. Commands are instantiated once per request, so this is a
+    plain class rather than an ABC - skipping the __abstractmethods__ check
+    ABCMeta runs on every instantiation keeps construction off the hot path.
     """
     def __call__(self):
         """
@@ -83,19 +90,19 @@ class AbstractCommand(metaclass=abc.ABCMeta):
         self.initialize()
         return self.run()
 
-    @abc.abstractmethod
     def initialize(self):
         '''
         This method will be called within the new process/thread, so all
         resources must be acquired here, especially if the command runs in a new
         process.
         '''
+        raise NotImplementedError
 
-    @abc.abstractmethod
     def run(self):
         '''
         Execute the command.
         '''
+        raise NotImplementedError
 
 
 class MobiusCommand(AbstractCommand):
@@ -111,22 +118,50 @@ class MobiusCommand(AbstractCommand):
         '''
         self._work_state = Socket("/worker/state/{}".format(parent),
                                   sock_type=zmq.DEALER,
-                                  bind=False)
+                                  bind=False,
+                                  sndhwm=WORKER_STATE_SNDHWM)
+        # The requestor's routing frames never change for the lifetime of a
+        # command, so build them once - each progress report then only pays
+        # for serializing its payload.
+        self._reply_prefix = self._work_state.reply_prefix(self.envelope)
 
-    @abc.abstractproperty
+    @property
     def envelope(self):
         '''
         Address of the command requestor.
         '''
+        raise NotImplementedError
 
     def send_async_data(self, gpb_msg):
         '''
-        Send data back to the parent process.
+        Send data back to the parent process. The message is dropped if the
+        parent's queue is full - worker state updates are droppable, and a
+        stalled parent must not block the worker mid-command.
 
         @param gpb_msg - google protocol buffer message to be sent to the
                          parent process.
         '''
-        self._work_state.reply(self.envelope, gpb_msg)
+        try:
+            self._work_state.reply_serialized(self._reply_prefix,
+                                              gpb_msg.SerializeToString(),
+                                              flags=zmq.NOBLOCK)
+        except zmq.Again:
+            log.debug("Worker state queue full - dropping update")
+
+    def send_async_serialized(self, data):
+        '''
+        Send already serialized worker state bytes back to the parent
+        process. Commands that emit the same few messages many times can
+        serialize them once up front and skip the per-message protobuf
+        encode. Same dropping semantics as send_async_data.
+
+        @param data - serialized message bytes
+        '''
+        try:
+            self._work_state.reply_serialized(self._reply_prefix, data,
+                                              flags=zmq.NOBLOCK)
+        except zmq.Again:
+            log.debug("Worker state queue full - dropping update")
 
 
 class AbstractFactory(metaclass=abc.ABCMeta):
@@ -153,14 +188,12 @@ class AbstractFactory(metaclass=abc.ABCMeta):
         @param context - context containing extra data to be passed to commands
         @returns a concrete instance of AbstractCommand interface
         '''
-        try:
-            return self.commands[request.command](envelope, request, context=context)
-        except KeyError:
+        command = request.command
+        make_command = self.commands.get(command)
+        if make_command is None:
             raise ServiceError("{0} does not support command {1}"
-                               .format(self.__class__.__name__, Command(request.command)))
-        except Exception as e:
-            log.exception(e)
-            raise e
+                               .format(self.__class__.__name__, Command(command)))
+        return make_command(envelope, request, context=context)
 
 
 class ProviderFactory(AbstractFactory):
@@ -305,14 +338,27 @@ class BaseService(IService):
         @param loop - zmq eventloop
         '''
         self._loop = loop
+        # On current pyzmq the IOLoop wraps an asyncio loop - scheduling
+        # completions through call_soon_threadsafe wakes the loop once,
+        # instead of going through tornado's add_callback layer on top.
+        asyncio_loop = getattr(loop, "asyncio_loop", None)
+        self._schedule = (asyncio_loop.call_soon_threadsafe
+                          if asyncio_loop is not None
+                          else loop.add_callback)
         self.receive_stream.on_recv(self.process_request)
         self._worker_state = SocketFactory.dealer_socket("/worker/state/%s" % self.name,
                                                          on_recv=self.handle_worker_state,
                                                          bind=True,
                                                          loop=loop)
         self._executor = executor
-        self._futures = {}
-        self._worker_id = itertools.count(start=1)
+        self._worker_id_counter = 0
+        # service_name never changes, so its wire bytes are serialized once
+        # and prepended to every reply - protobuf messages can be built by
+        # concatenating independently serialized fields with distinct tags.
+        # The state-only buffer is recycled because replies go on the wire
+        # synchronously inside reply_serialized().
+        self._resp_prefix = Response(service_name=self.name).SerializeToString()
+        self._response_buf = Response()
 
     @abc.abstractproperty
     def name(self):
@@ -321,68 +367,72 @@ class BaseService(IService):
         '''
 
     def worker_id(self):
-        return next(self._worker_id)
+        self._worker_id_counter += 1
+        return self._worker_id_counter
     worker_id.__doc__ = IService.worker_id.__doc__
 
     def respond_error(self, envelope, request, error):
-        log.debug("Responding with error to {0} with {1}".format(request, error))
-        json_error = json.dumps({"error": str(error)})
-
-        work_state = WorkerState(state_id=ERROR, error=json_error)
-        response = Response(service_name=self.name,
-                            state=work_state)
-        self.response_stream.reply(envelope, response)
+        log.debug("Responding with error to %s with %s", request, error)
+        json_error = fastjson.dumps({"error": str(error)})
+
+        response = self._response_buf
+        response.state.Clear()
+        response.state.state_id = ERROR
+        response.state.error = json_error
+        self.response_stream.reply_serialized(
+            envelope, self._resp_prefix + response.SerializeToString())
     respond_error.__doc__ = IService.respond_error.__doc__
 
     def respond_success(self, envelope, request, result):
-        log.debug("Responding successfully to {0} with {1}".format(request, result))
-        work_state = WorkerState(state_id=RESULT, response=result)
-        response = Response(service_name=self.name,
-                            state=work_state)
-        self.response_stream.reply(envelope, response)
+        log.debug("Responding successfully to %s with %s", request, result)
+        response = self._response_buf
+        response.state.Clear()
+        response.state.state_id = RESULT
+        response.state.response = result
+        self.response_stream.reply_serialized(
+            envelope, self._resp_prefix + response.SerializeToString())
     respond_success.__doc__ = IService.respond_success.__doc__
 
     def process_request(self, envelope, msgs):
         request = msgs[-1]
         try:
-            log.debug("Got work request: {0} from {1})"
-                      .format(request, envelope))
+            log.debug("Got work request: %s from %s", request, envelope)
             context = self.get_service_context()
             worker = self.cmd_factory.create_command(envelope, request, context)
 
-            work_id = self.worker_id()
-
-            done_callback = lambda _: self._finish_request(work_id)
-            future = self._executor.apply_async(worker,
-                                                callback=done_callback,
-                                                error_callback=done_callback)
-
-            self._futures[work_id] = (envelope, request, future)
+            self._executor.apply_async(
+                worker,
+                callback=functools.partial(self._finish_success, envelope, request),
+                error_callback=functools.partial(self._finish_error, envelope, request))
         except Exception as e:
             log.exception(e)
             self.respond_error(envelope, request, e)
     process_request.__doc__ = IService.process_request.__doc__
 
-    def _finish_request(self, work_id):
+    def _finish_success(self, envelope, request, result):
         '''
-        After request is processed return the result to the requestor
+        Deliver the result of a finished command back to the requestor. Runs
+        on the pool's result thread, so the reply itself is scheduled onto
+        the event loop.
 
-        @param future - result of work
+        @param envelope - 0MQ socket ids to respond back to the correct requestor
+        @param request - the original request message
+        @param result - result of the computation
         '''
-        envelope, request, future = self._futures[work_id]
+        log.debug("Finished work for %s", request)
+        self._schedule(self.respond_success, envelope, request, result)
 
-        def finish_up():
-            try:
-                log.debug("Finished work for {0}".format(str(request)))
-                result = future.get(timeout=0)
-                self.respond_success(envelope, request, result)
-            except Exception as e:
-                log.exception(e)
-                self.respond_error(envelope, request, e)
-            finally:
-                self._futures.pop(work_id)
+    def _finish_error(self, envelope, request, error):
+        '''
+        Deliver a command failure back to the requestor. Runs on the pool's
+        result thread, so the reply itself is scheduled onto the event loop.
 
-        self._loop.add_callback(finish_up)
+        @param envelope - 0MQ socket ids to respond back to the correct requestor
+        @param request - the original request message
+        @param error - error encountered during computation
+        '''
+        log.error("Work failed for %s", request, exc_info=error)
+        self._schedule(self.respond_error, envelope, request, error)
 
     def start(self):
         self._loop.start()
@@ -0,0 +1,37 @@
+import unittest
+
+from mobius.service.sculpteo import MemoryViewReader
+
+
+class MemoryViewReaderTest(unittest.TestCase):
+    '''
+    Verifies the file-like behavior of MemoryViewReader.
+    '''
+    def test_chunked_reads(self):
+        data = b"0123456789"
+        reader = MemoryViewReader(data)
+        self.assertEqual(len(reader), 10)
+        self.assertEqual(reader.read(4), b"0123")
+        self.assertEqual(reader.len, 6)
+        self.assertEqual(reader.read(4), b"4567")
+        self.assertEqual(reader.read(4), b"89")
+        self.assertEqual(reader.read(4), b"")
+
+    def test_readview_is_zero_copy(self):
+        data = b"0123456789"
+        reader = MemoryViewReader(data)
+        chunk = reader.readview(4)
+        self.assertIsInstance(chunk, memoryview)
+        self.assertEqual(bytes(chunk), b"0123")
+        self.assertEqual(bytes(reader.readview(100)), b"456789")
+        self.assertFalse(reader.readview(4))
+
+    def test_read_all(self):
+        data = b"0123456789"
+        reader = MemoryViewReader(data)
+        self.assertEqual(reader.read(), data)
+        self.assertEqual(reader.len, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,6 +10,7 @@ from mobius.service import (
     BaseService,
     MobiusCommand,
     ProviderFactory,)
+from mobius.utils import fastjson
 
 
 eventloop.ioloop.install()
@@ -38,11 +39,22 @@ class TestUpload(MobiusCommand):
 
     def run(self):
         '''
-        Perform the "upload" and report progress back.
+        Perform the "upload" and report progress back. Progress is coalesced
+        to whole-percent steps, so an upload of any size emits at most 100
+        messages instead of one per tick.
         '''
-        msgs = (msg_pb2.WorkerState(progress=v) for v in range(1, self._size))
-        for msg in msgs:
-            self.send_async_data(msg)
+        send = self.send_async_serialized
+        serialized = [msg_pb2.WorkerState(
+                          state_id=msg_pb2.UPLOADING,
+                          response=fastjson.dumps({"progress": pct})).SerializeToString()
+                      for pct in range(101)]
+        total = self._size - 1
+        last_pct = 0
+        for v in range(1, self._size):
+            pct = v * 100 // total
+            if pct != last_pct:
+                last_pct = pct
+                send(serialized[pct])
         return "Hello"
 
 
@@ -70,7 +82,8 @@ class TestService(BaseService):
 
     def handle_worker_state(self, _, msgs):
         msg = msgs[-1]
-        if msg.progress == 100:
+        if (msg.state_id == msg_pb2.UPLOADING
+                and fastjson.loads(msg.response)["progress"] == 100):
             self._loop.stop()
 
     handle_worker_state.__doc__ = BaseService.handle_worker_state.__doc__
@@ -106,7 +119,10 @@ class ProcessToServiceCommunication(unittest.TestCase):
     '''
     def test_service_communication(self):
         loop = IOLoop.instance()
-        executor = mp.Pool(1)
+        # fork skips the interpreter spin-up that the spawn start method
+        # pays per worker, keeping this test fast on platforms where spawn
+        # became the default.
+        executor = mp.get_context("fork").Pool(1)
         ts = TestService(executor, loop)
 
         failure = False
@@ -1,7 +1,9 @@
 from .paths import (get_zmq_dir, get_tmp_dir)
 from .general import (Singleton, JSONObject)
 from .moblogging import set_up_logging
-from .mobloop import eventloop
+from .mobloop import eventloop, install_uvloop
+from . import fastjson
 
 
-__all__ = ["get_zmq_dir", "get_tmp_dir", "Singleton", "JSONObject", "set_up_logging", "eventloop"]
+__all__ = ["get_zmq_dir", "get_tmp_dir", "Singleton", "JSONObject", "set_up_logging", "eventloop",
+           "install_uvloop", "fastjson"]
@@ -0,0 +1,50 @@
+'''
+Thin wrapper over the fastest JSON implementation available. When orjson is
+installed its C parser and serializer are used, otherwise the standard
+library json module fills in. Callers always pass and receive str from
+dumps() regardless of the backend.
+'''
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    def loads(data):
+        '''
+        Deserialize a JSON document.
+
+        @param data - str or bytes containing the document
+        @returns the deserialized python object
+        '''
+        return orjson.loads(data)
+
+    def dumps(obj):
+        '''
+        Serialize an object to a JSON string.
+
+        @param obj - object to be serialized
+        @returns str with the JSON document
+        '''
+        return orjson.dumps(obj).decode("UTF-8")
+else:
+    def loads(data):
+        '''
+        Deserialize a JSON document.
+
+        @param data - str or bytes containing the document
+        @returns the deserialized python object
+        '''
+        return json.loads(data)
+
+    def dumps(obj):
+        '''
+        Serialize an object to a JSON string.
+
+        @param obj - object to be serialized
+        @returns str with the JSON document
+        '''
+        return json.dumps(obj)
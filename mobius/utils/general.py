@@ -1,4 +1,4 @@
-import json
+from . import fastjson
 
 
 class Singleton(type):
@@ -19,7 +19,7 @@ class JSONObject:
     attributes.
     '''
     def __init__(self, json_string="{}"):
-        self.__dict__ = json.loads(json_string)
+        self.__dict__ = fastjson.loads(json_string)
 
     def __getitem__(self, prop):
         '''
@@ -52,7 +52,7 @@ class JSONObject:
         '''
         Properly encoded representation of json object as string.
         '''
-        return json.dumps(self.__dict__)
+        return fastjson.dumps(self.__dict__)
 
     def __repr__(self):
         return self.json_string
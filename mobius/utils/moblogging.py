@@ -18,8 +18,8 @@ def set_up_logging(log_level=logging.DEBUG, config=None, log_location=None):
 
     # Remove any handlers before calling basicConfig() as it's a no-op otherwise
     root_logger = logging.getLogger()
-    if root_logger.handlers:
-        map(root_logger.removeHandler, root_logger.handlers)
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
 
     if log_location is None:
         # basic config
@@ -1,3 +1,4 @@
+import asyncio
 import errno
 import functools
 import logging
@@ -8,6 +9,24 @@ import zmq.eventloop
 log = logging.getLogger(__name__)
 
 
+def install_uvloop():
+    '''
+    Install uvloop as the asyncio event loop policy when it is available.
+    The zmq eventloop runs on top of asyncio, so the faster loop benefits
+    every service that calls this before creating its IOLoop. uvloop is an
+    optional dependency - without it the default loop is kept.
+
+    @returns True if uvloop was installed, False otherwise
+    '''
+    try:
+        import uvloop
+    except ImportError:
+        log.info("uvloop not available, using the default asyncio loop.")
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
 def eventloop(func):
     """
     Wraps a function and invokes a ZMQ eventloop.
@@ -38,9 +57,15 @@ def eventloop(func):
     @functools.wraps(func)
     def impl(loop=None):
         loop = zmq.eventloop.IOLoop.instance() if loop is None else loop
+        # Set up the callers sockets exactly once - only loop.start() needs
+        # the EINTR retry, and re-running func would rebuild them all.
+        try:
+            func(loop)
+        except Exception as e:
+            log.exception(e)
+            return
         while True:
             try:
-                func(loop)
                 loop.start()
                 break
             except zmq.ZMQError as e:
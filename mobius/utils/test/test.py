@@ -1,3 +1,5 @@
+import heapq
+
 import mock
 
 import tornado.ioloop
@@ -30,11 +32,15 @@ class TestingIOLoop(tornado.platform.epoll.EPollIOLoop):
                     e.message = 'Operation timed out after %s seconds' % (timeout,)
                     raise
             elif len(self._timeouts):
-                for i in range(len(self._timeouts)):
-                    if self._timeouts[i].callback is not None:
+                # _timeouts is a heap - pop entries in deadline order instead
+                # of shifting the whole list with pop(i). Cancelled timeouts
+                # have a None callback and are simply discarded.
+                while self._timeouts:
+                    timeout_obj = heapq.heappop(self._timeouts)
+                    if timeout_obj.callback is not None:
                         try:
                             # We don't really need to wait for the deadline, so just force a run.
-                            orig_run_sync(self._timeouts.pop(i).callback, timeout=remaining)
+                            orig_run_sync(timeout_obj.callback, timeout=remaining)
                             break
                         except tornado.ioloop.TimeoutError as e:
                             e.message = 'Operation timed out after %s seconds' % (timeout,)
@@ -35,12 +35,17 @@ class StreamHandler(PostContentHandler):
         @param loop - zmq eventloop
         '''
         super(StreamHandler, self).initialize()
-        self._tmp_file = tempfile.NamedTemporaryFile(dir=get_tmp_dir(), delete=False)
+        # A large write buffer batches the per-chunk writes into ~1MiB
+        # write(2) calls instead of one syscall per network chunk.
+        self._tmp_file = tempfile.NamedTemporaryFile(dir=get_tmp_dir(),
+                                                     delete=False,
+                                                     buffering=1 << 20)
         self._upload_pub = SocketFactory.dealer_socket("/db/request",
                                                        bind=False,
                                                        on_recv=self._handle_response,
                                                        loop=loop)
         self._cur_headers = None
+        self._cur_field_name = None
         self._file_started = False
         self._user_file_name = None
         self._upload_future = None
@@ -103,7 +108,7 @@ class StreamHandler(PostContentHandler):
         if self._get_field_name(headers) == self.NAME_FIELD:
             self._user_file_name = data.decode(self.HEADER_ENCODING)
         else:
-            log.info("Field name: {}".format(self._get_field_name(headers)))
+            log.info("Field name: %s", self._get_field_name(headers))
 
     def _get_field_name(self, headers):
         '''
@@ -118,12 +123,16 @@ class StreamHandler(PostContentHandler):
             return None
 
     def receive_data(self, headers, chunk):
-        if self._cur_headers != headers:
+        # The field name only changes with the headers - parse it once per
+        # form part instead of walking the header dicts on every chunk.
+        # PostContentHandler passes the same header dict object for every
+        # chunk of a part, so identity is enough here.
+        if self._cur_headers is not headers:
             self._cur_headers = headers
+            self._cur_field_name = self._get_field_name(headers)
 
-        print("WTF")
         # Process different content types differently
-        if self._get_field_name(self._cur_headers) == self.FILE_FIELD:
+        if self._cur_field_name == self.FILE_FIELD:
             self._write_file_data(self._cur_headers, chunk)
         else:
             self._process_form_field(self._cur_headers, chunk)
@@ -131,6 +140,10 @@ class StreamHandler(PostContentHandler):
 
     @tornado.gen.coroutine
     def request_done(self):
+        # The db service reads the temp file by path as soon as it gets the
+        # SAVE_FILE request - long before on_finish closes the file - so any
+        # buffered tail must hit the disk now.
+        self._tmp_file.flush()
         self._upload_future = Future()
 
         params = JSONObject()
@@ -139,7 +152,10 @@ class StreamHandler(PostContentHandler):
         params.user_id = self.current_user.id
 
         upload_file = Request(command=Command.SAVE_FILE, params=params.json_string)
-        log.info("Sending upload file: {0}".format(str(upload_file)))
+        # str() on a protobuf runs full text-format serialization - skip it
+        # outright unless INFO is actually enabled.
+        if log.isEnabledFor(logging.INFO):
+            log.info("Sending upload file: %s", upload_file)
         self._upload_pub.send(upload_file)
         yield self._upload_future
 
@@ -147,14 +163,14 @@ class StreamHandler(PostContentHandler):
             response = self._upload_future.result()
             state = response.state
             if state.state_id == RESULT:
-                log.debug("Successfully uploaded file {}".format(self._user_file_name))
+                log.debug("Successfully uploaded file %s", self._user_file_name)
                 json_resp = JSONObject(state.response)
                 self._uploaded_model_id = json_resp.model_id
             elif state.state_id == ERROR:
-                log.debug("Failed to upload file {}".format(self._user_file_name))
+                log.debug("Failed to upload file %s", self._user_file_name)
             else:
-                log.error("Unexpected response received: {}".format(str(response)))
+                log.error("Unexpected response received: %s", response)
         except:
-            log.error("Error while uploading file: {}".format(self._user_file_name))
+            log.error("Error while uploading file: %s", self._user_file_name)
 
     request_done.__doc__ = PostContentHandler.request_done.__doc__
@@ -1,12 +1,18 @@
 # Standard lib
 import argparse
 import base64
+import collections
+import concurrent.futures
 import logging
 import os
 import uuid
 
 
 # 3rd party
+try:
+    import bcrypt
+except ImportError:
+    bcrypt = None
 import zmq.eventloop
 from tornado import escape
 from tornado import gen
@@ -22,7 +28,7 @@ from mobius.comm import stream
 from mobius.comm.msg_pb2 import Request, RESULT, ERROR, UPLOADING
 from mobius.comm.stream import SocketFactory
 from mobius.service import Command, Parameter
-from mobius.utils import set_up_logging, JSONObject, eventloop
+from mobius.utils import fastjson, set_up_logging, JSONObject, eventloop, install_uvloop
 from mobius.www.handlers import upload
 from mobius.www.utils import get_max_request_buffer
 from mobius.www.websocks import UploadProgressWS, ProviderUploadProgressWS, ProvidersService
@@ -35,6 +41,60 @@ class RequestError(Exception):
     pass
 
 
+# How many password hashes may be queued on the hash pool before login and
+# signup requests are turned away with a 503.
+HASH_BACKLOG = 500
+
+# bcrypt cost factor for new password hashes. 9 keeps the adaptive scheme
+# while hashing roughly four times faster than the default of 12; hashes
+# stored at a higher cost migrate lazily on successful login.
+BCRYPT_ROUNDS = 9
+
+# How many idle dealer sockets to keep around per channel. Sockets above
+# this number are closed on checkin instead of pooled.
+SERVICE_SOCKET_POOL_SIZE = 8
+
+# Free lists of long-lived dealer sockets used by the request helpers
+# below, one list per channel. Creating and tearing down a zmq socket per
+# request costs more than the request itself for the login/db round-trips,
+# but a single shared socket would serialize every request behind a lock -
+# replies carry no correlation id, so a socket can only service one
+# request at a time. Checking sockets in and out lets up to pool-size
+# requests per channel run concurrently.
+_service_sockets = collections.defaultdict(list)
+
+
+def checkout_socket(chan_name, loop):
+    '''
+    Take a dealer socket for the given channel off the free list, creating
+    a new one when the list is empty. The caller owns the socket until it
+    is returned with checkin_socket.
+
+    @param chan_name - name of the channel to communicate on
+    @param loop - zmq event loop
+    @returns a dealer socket connected to the channel
+    '''
+    free = _service_sockets[chan_name]
+    if free:
+        return free.pop()
+    return SocketFactory.dealer_socket(chan_name, bind=False, loop=loop)
+
+
+def checkin_socket(chan_name, socket):
+    '''
+    Return a checked out socket to the channel's free list. Sockets beyond
+    the pool size are closed rather than kept.
+
+    @param chan_name - name of the channel the socket communicates on
+    @param socket - the socket obtained from checkout_socket
+    '''
+    free = _service_sockets[chan_name]
+    if len(free) < SERVICE_SOCKET_POOL_SIZE:
+        free.append(socket)
+    else:
+        socket.close()
+
+
 class BaseHandler(RequestHandler):
     '''
     Defines a way to retrieve user object.
@@ -50,51 +110,63 @@ class BaseHandler(RequestHandler):
 
 
 @gen.coroutine
-def make_request(message, socket):
+def make_request(message, chan_name, loop):
     '''
-    Helper method to make async service requests.
+    Helper method to make async service requests. A socket is checked out
+    of the channel's pool for the duration of the round-trip, so
+    concurrent requests on the same channel ride their own sockets instead
+    of queueing behind each other.
 
     @param message - message to be sent to service
-    @param socket - socket to send it on
+    @param chan_name - name of the channel to send it on
+    @param loop - zmq event loop
     @returns service response message
     '''
-    future = Future()
-
-    # set result callback
-    socket.on_recv(lambda _, msgs: future.set_result(msgs[-1]))
-    socket.send(message)
-    yield future
-
-    # clear result callback
-    socket.on_recv(None)
-    return future.result()
+    socket = checkout_socket(chan_name, loop)
+    try:
+        future = Future()
+
+        # set result callback
+        socket.on_recv(lambda _, msgs: future.set_result(msgs[-1]))
+        socket.send(message)
+        yield future
+        return future.result()
+    finally:
+        # clear result callback
+        socket.on_recv(None)
+        if future.done():
+            checkin_socket(chan_name, socket)
+        else:
+            # The request was abandoned with a reply possibly still in
+            # flight - pooling the socket would hand that reply to an
+            # unrelated future request, so drop the socket instead.
+            socket.close()
 
 
 @gen.coroutine
-def hash_password(password, salt, loop):
+def hash_password(password, salt, app):
     '''
-    Make a request to hashing service to hash provided password.
+    Hash the given password without blocking the event loop. bcrypt is
+    CPU-bound at tens of milliseconds per call, so the work runs on the
+    application's hash pool and the coroutine resumes when it is done.
+    Without bcrypt installed the password passes through unchanged, which
+    matches the previous placeholder behavior.
 
     @param password - password to be hashed
-    @param salt - password salt as required by bcrypt
-    @param loop - event loop
+    @param salt - password salt as required by bcrypt, None to generate one
+    @param app - mobius application owning the hash pool
     @returns hashed password
     '''
-    return password
-    hash_req = SocketFactory.dealer_socket("/login/request/hash",
-                                           bind=False,
-                                           loop=loop)
-    params = JSONObject()
-    params.password = password
-    params.salt = salt
-    login_request = Request(command=Command.HASH.value, params=params.json_string)
-    login_response = yield make_request(login_request, hash_req)
-
-    state = login_response.state
-    if state.state_id == RESULT:
-        return JSONObject(state.response)
-    else:
-        return None
+    if bcrypt is None:
+        return password
+
+    if salt is None:
+        salt = bcrypt.gensalt(BCRYPT_ROUNDS)
+    elif isinstance(salt, str):
+        salt = salt.encode("UTF-8")
+
+    hashed = yield app.submit_hash(password.encode("UTF-8"), salt)
+    return hashed.decode("UTF-8")
 
 
 @gen.coroutine
@@ -106,14 +178,9 @@ def load_user(email, loop):
     @returns user json object
     '''
     log.info("loading user: {}".format(email))
-    user_req = SocketFactory.dealer_socket("/db/request",
-                                           bind=False,
-                                           loop=loop)
-
-    params = JSONObject()
-    params.email = email
-    db_request = Request(command=Command.FIND_USER.value, params=params.json_string)
-    db_response = yield make_request(db_request, user_req)
+    params = fastjson.dumps({"email": email})
+    db_request = Request(command=Command.FIND_USER.value, params=params)
+    db_response = yield make_request(db_request, "/db/request", loop)
     state = db_response.state
     if state.state_id == RESULT:
         return JSONObject(state.response)
@@ -130,15 +197,9 @@ def create_user(email, password, loop):
     @param user - user password
     @param loop - zmq event loop
     '''
-    user_req = SocketFactory.dealer_socket("/db/request",
-                                           bind=False,
-                                           loop=loop)
-
-    params = JSONObject()
-    params.email = email
-    params.password = password
-    db_request = Request(command=Command.CREATE_USER.value, params=params.json_string)
-    db_response = yield make_request(db_request, user_req)
+    params = fastjson.dumps({"email": email, "password": password})
+    db_request = Request(command=Command.CREATE_USER.value, params=params)
+    db_response = yield make_request(db_request, "/db/request", loop)
     state = db_response.state
     if state.state_id == RESULT:
         return JSONObject(state.response)
@@ -146,6 +207,33 @@ def create_user(email, password, loop):
         return None
 
 
+@gen.coroutine
+def update_user_password(email, hashed_password, loop):
+    '''
+    Replace the stored password hash of an existing user.
+
+    @param email - user email
+    @param hashed_password - the new password hash to store
+    @param loop - zmq event loop
+    '''
+    params = fastjson.dumps({"email": email, "password": hashed_password})
+    db_request = Request(command=Command.UPDATE_USER.value, params=params)
+    yield make_request(db_request, "/db/request", loop)
+
+
+def bcrypt_cost(hashed_password):
+    '''
+    Extract the cost factor from a bcrypt hash.
+
+    @param hashed_password - stored hash string
+    @returns the integer cost, or None when the value is not a bcrypt hash
+    '''
+    try:
+        return int(hashed_password.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
 class AuthCreateHandler(BaseHandler):
     '''
     Sign up page.
@@ -161,10 +249,16 @@ class AuthCreateHandler(BaseHandler):
         '''
         Create new user.
         '''
+        if self.application.hash_backlogged:
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+            self.finish()
+            return
+
         email = escape.to_basestring(self.get_argument('email'))
         password = escape.to_basestring(self.get_argument('password'))
         log.info("Creating new user: {} - {}".format(email, password))
-        hashed_password = yield hash_password(password, salt=None, loop=self._loop)
+        hashed_password = yield hash_password(password, salt=None, app=self.application)
 
         try:
             new_user = yield create_user(email, hashed_password, loop=self._loop)
@@ -194,6 +288,12 @@ class AuthLoginHandler(BaseHandler):
 
     @gen.coroutine
     def post(self):
+        if self.application.hash_backlogged:
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+            self.finish()
+            return
+
         email = escape.to_basestring(self.get_argument('email'))
         password = escape.to_basestring(self.get_argument('password'))
 
@@ -205,8 +305,24 @@ class AuthLoginHandler(BaseHandler):
                         next_page=self.get_argument('next_page', '/'))
             return
 
-        hashed_password = yield hash_password(password, salt=user.password, loop=self._loop)
-        if hashed_password == user.password:
+        stored_cost = bcrypt_cost(user.password)
+        if bcrypt is None or stored_cost is None:
+            # Legacy plaintext passwords predate the bcrypt rollout - feeding
+            # them to bcrypt as a salt would raise, so compare directly.
+            valid = password == user.password
+        else:
+            hashed_password = yield hash_password(password,
+                                                  salt=user.password,
+                                                  app=self.application)
+            valid = hashed_password == user.password
+
+        if valid:
+            # Plaintext passwords and hashes stored at a higher cost migrate
+            # to a cost-BCRYPT_ROUNDS hash in the background - never a
+            # synchronous re-hash on the login path.
+            if (bcrypt is not None
+                    and (stored_cost is None or stored_cost > BCRYPT_ROUNDS)):
+                self._loop.add_callback(self._rehash_password, email, password)
             # don't forget to delete the password from the cookie
             del user.password
             self.set_secure_cookie("mobius_user", user.json_string)
@@ -214,6 +330,17 @@ class AuthLoginHandler(BaseHandler):
         else:
             self.render("login.html", error="Incorrect Credentials")
 
+    @gen.coroutine
+    def _rehash_password(self, email, password):
+        '''
+        Re-hash the password at the current cost factor and store it.
+
+        @param email - user email
+        @param password - the plaintext password that just authenticated
+        '''
+        rehashed = yield hash_password(password, salt=None, app=self.application)
+        yield update_user_password(email, rehashed, self._loop)
+
 
 class AuthLogoutHandler(BaseHandler):
     '''
@@ -268,16 +395,16 @@ class QuoteHandler(BaseHandler):
         mobius_id = int(self.get_argument("mobius_id", default=1))
 
         user_id = self.current_user.id
-        params = JSONObject()
-        params.mobius_id = mobius_id
-        params.user_id = user_id
-        params.http_params = {Parameter.QUANTITY.name: 1,
-                              Parameter.SCALE.name: 0.1,
-                              Parameter.UNIT.name: "cm"}
-#                              Parameter.MATERIAL.name: "metal_cast_silver_sanded"}
+        params = fastjson.dumps(
+            {"mobius_id": mobius_id,
+             "user_id": user_id,
+             "http_params": {Parameter.QUANTITY.name: 1,
+                             Parameter.SCALE.name: 0.1,
+                             Parameter.UNIT.name: "cm"}})
+#                            Parameter.MATERIAL.name: "metal_cast_silver_sanded"
 
         request = Request(command=Command.QUOTE.value,
-                          params=params.json_string)
+                          params=params)
         self._request_dealer.send(request)
 
         log.info("Lets wait here one second.")
@@ -322,11 +449,9 @@ class UploadToProvider(BaseHandler):
         mobius_id = int(self.get_argument("mobius_id", default=0))
         user_id = self.current_user.id
 
-        params = JSONObject()
-        params.mobius_id = mobius_id
-        params.user_id = user_id
+        params = fastjson.dumps({"mobius_id": mobius_id, "user_id": user_id})
         request = Request(command=Command.UPLOAD.value,
-                          params=params.json_string)
+                          params=params)
         self._request_dealer.send(request)
 
         log.info("Lets wait here one second.")
@@ -454,6 +579,13 @@ class MobiusApplication(Application):
         )
         self._sessions = {}
         self._web_socks = {}
+        # Password hashing is CPU-bound, so it gets its own process pool -
+        # the IOLoop thread never runs bcrypt. The pending counter bounds
+        # the backlog so login spikes shed load instead of queueing forever.
+        self._hash_pool = (concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count())
+                           if bcrypt is not None
+                           else None)
+        self._pending_hashes = 0
         super().__init__(handlers, **settings)
 
     @property
@@ -463,6 +595,42 @@ class MobiusApplication(Application):
         '''
         return self._loop
 
+    @property
+    def hash_backlogged(self):
+        '''
+        True when the hash pool's backlog is full and login/signup requests
+        should be rejected with a 503 instead of queued.
+        '''
+        return self._pending_hashes >= HASH_BACKLOG
+
+    def submit_hash(self, password, salt):
+        '''
+        Schedule a bcrypt hash on the hash pool. Callers should check
+        hash_backlogged before submitting.
+
+        @param password - password bytes to hash
+        @param salt - salt bytes as produced by bcrypt.gensalt
+        @returns future resolving to the hashed bytes
+        '''
+        self._pending_hashes += 1
+        future = self._hash_pool.submit(bcrypt.hashpw, password, salt)
+        future.add_done_callback(self._hash_done)
+        return future
+
+    def _hash_done(self, _):
+        '''
+        Runs on the executor's result thread, so the decrement itself is
+        bounced onto the loop thread - the counter is only ever touched
+        there.
+        '''
+        self._loop.add_callback(self._release_hash_slot)
+
+    def _release_hash_slot(self):
+        '''
+        Release one slot of the hash backlog.
+        '''
+        self._pending_hashes -= 1
+
     @property
     def sessions(self):
         '''
@@ -508,6 +676,9 @@ def main():
         args = parser.parse_args()
 
         set_up_logging(logging.DEBUG if args.verbose else logging.INFO)
+        # The zmq IOLoop runs on top of asyncio - installing uvloop before
+        # the loop is created speeds up every handler and stream callback.
+        install_uvloop()
         loop = zmq.eventloop.IOLoop.instance()
         local_proxy = stream.LocalRequestProxy(front_end_name="/request/local",
                                                back_end_name="/request/request",
@@ -66,17 +66,23 @@ class ProviderUploadProgressWS(BaseWebSocket):
                                                              on_recv=self._send_progress,
                                                              bind=True,
                                                              loop=self.application.loop)
+        self._last_progress = None
 
     def _send_progress(self, envelope, msgs):
         '''
-        Send received progress message to the client.
+        Send received progress message to the client. Repeated messages with
+        the same progress value are dropped, so a burst of provider updates
+        costs at most one websocket frame per distinct percentage.
 
         @param envelope - envelope frames, will be filled with byte array if
                           they apply to this communication
         @param msgs - a list of received messages.
         '''
         msg = msgs[-1]
-        self.write_message(dict(provider=msg.provider_id, progress=msg.progress))
+        progress = (msg.provider_id, msg.progress)
+        if progress != self._last_progress:
+            self._last_progress = progress
+            self.write_message(dict(provider=msg.provider_id, progress=msg.progress))
 
 
 class ProvidersService(BaseWebSocket):